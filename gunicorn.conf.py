@@ -0,0 +1,19 @@
+# Gunicorn settings for running the API outside of Vercel
+import os
+
+bind = f"0.0.0.0:{os.environ.get('PORT', '8080')}"
+
+# Requests spend most of their time waiting on Kia's servers, so use threaded
+# workers to keep several Kia calls in flight at once. The Kia client is built
+# on blocking requests calls, so threads rather than an async server are what
+# let those calls overlap.
+workers = int(os.environ.get("WEB_CONCURRENCY", "4"))
+worker_class = "gthread"
+threads = 8
+
+# Each worker imports main.py after forking and builds its own VehicleManager
+# and HTTP session, which are not safe to share across processes
+preload_app = False
+
+# Kia commands can take a while to round-trip
+timeout = 60
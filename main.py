@@ -1,10 +1,40 @@
+import atexit
+import hashlib
+import hmac
+import logging
+import logging.handlers
 import os
-from flask import Flask, request, jsonify
+import queue
+import sys
+import threading
+import time
+import fastjsonschema
+import orjson
+from flask import Flask, Response, request
+from urllib3.util.retry import Retry
 from hyundai_kia_connect_api import VehicleManager, ClimateRequestOptions
 from hyundai_kia_connect_api.exceptions import AuthenticationError
 
 app = Flask(__name__)
 
+# Log through a queue so request threads hand records off instead of writing
+# to stdout themselves. Vercel freezes the process between invocations, which
+# would strand records still in the queue, so log to stdout directly there.
+logger = logging.getLogger(__name__)
+logger.setLevel(os.environ.get("LOG_LEVEL", "INFO").upper())
+logger.propagate = False
+_log_handler = logging.StreamHandler(sys.stdout)
+_log_handler.setFormatter(logging.Formatter("%(asctime)s %(levelname)s %(message)s"))
+if os.environ.get("VERCEL"):
+    _log_listener = None
+    logger.addHandler(_log_handler)
+else:
+    _log_queue = queue.SimpleQueue()
+    _log_listener = logging.handlers.QueueListener(_log_queue, _log_handler)
+    _log_listener.start()
+    atexit.register(_log_listener.stop)
+    logger.addHandler(logging.handlers.QueueHandler(_log_queue))
+
 # Get credentials from environment variables
 USERNAME = os.environ.get('KIA_USERNAME')
 PASSWORD = os.environ.get('KIA_PASSWORD')
@@ -13,189 +43,431 @@ PIN = os.environ.get('KIA_PIN')
 if USERNAME is None or PASSWORD is None or PIN is None:
     raise ValueError("Missing credentials! Check your environment variables.")
 
-# Initialize Vehicle Manager
-vehicle_manager = VehicleManager(
-    region=1,  # North America region
-    brand=1,   # KIA brand
-    username=USERNAME,
-    password=PASSWORD,
-    pin=str(PIN)
-)
-
-# Refresh the token and update vehicle states
-try:
-    print("Attempting to authenticate and refresh token...")
-    vehicle_manager.check_and_refresh_token()
-    print("Token refreshed successfully.")
-    print("Updating vehicle states...")
-    vehicle_manager.update_all_vehicles_with_cached_state()
-    print(f"Connected! Found {len(vehicle_manager.vehicles)} vehicle(s).")
-except AuthenticationError as e:
-    print(f"Failed to authenticate: {e}")
-    exit(1)
-except Exception as e:
-    print(f"Unexpected error during initialization: {e}")
-    exit(1)
-
 # Secret key for security - moved to environment variables
 SECRET_KEY = os.environ.get("SECRET_KEY")
 if not SECRET_KEY:
     raise ValueError("Missing SECRET_KEY environment variable.")
+SECRET_KEY_BYTES = SECRET_KEY.encode()
 
-# Dynamically fetch the first vehicle ID if VEHICLE_ID is not set
+# Vehicle to control; if unset, the first vehicle on the account is used once
+# the Vehicle Manager has logged in
 VEHICLE_ID = os.environ.get("VEHICLE_ID")
-if not VEHICLE_ID:
-    if not vehicle_manager.vehicles:
-        raise ValueError("No vehicles found in the account. Please ensure your Kia account has at least one vehicle.")
-    # Fetch the first vehicle ID
-    VEHICLE_ID = next(iter(vehicle_manager.vehicles.keys()))
-    print(f"No VEHICLE_ID provided. Using the first vehicle found: {VEHICLE_ID}")
+
+# Share one pooled keep-alive session for all Kia API calls so each command
+# doesn't pay a fresh TCP + TLS handshake
+def install_pooled_session(api):
+    # Only some regional clients keep a session; the rest make per-call requests
+    session = getattr(api, "session", None)
+    if session is None:
+        return
+    # Keep the library's adapter class, it may carry a custom SSL context
+    adapter_class = type(session.get_adapter("https://"))
+    session.mount("https://", adapter_class(
+        pool_connections=10,
+        pool_maxsize=20,
+        max_retries=Retry(total=2, backoff_factor=0.2)
+    ))
+
+# Kia answers a login with bad credentials with 401 or 403. The EU client
+# raises AuthenticationError for that itself, but the US client reports it the
+# same way as an outage, so raise it here from the status code.
+def _check_login_status(response, *args, **kwargs):
+    if response.status_code in (401, 403) and response.request.path_url.endswith("/prof/authUser"):
+        raise AuthenticationError(f"Kia rejected the login (HTTP {response.status_code})")
+
+def install_login_check(api):
+    session = getattr(api, "session", None)
+    if session is not None:
+        session.hooks["response"].append(_check_login_status)
+
+def _create_vehicle_manager():
+    global VEHICLE_ID
+    vehicle_manager = VehicleManager(
+        region=1,  # North America region
+        brand=1,   # KIA brand
+        username=USERNAME,
+        password=PASSWORD,
+        pin=str(PIN)
+    )
+    install_pooled_session(vehicle_manager.api)
+    install_login_check(vehicle_manager.api)
+
+    # Log in and load the account's vehicles. Vehicle states are fetched by the
+    # first ensure_fresh() call, so startup only pays for the login.
+    try:
+        logger.info("Attempting to authenticate and refresh token...")
+        vehicle_manager.check_and_refresh_token()
+        logger.info("Connected! Found %d vehicle(s).", len(vehicle_manager.vehicles))
+    except AuthenticationError as e:
+        logger.error("Failed to authenticate: %s", e)
+        raise
+    except Exception as e:
+        logger.error("Unexpected error during initialization: %s", e)
+        raise
+
+    # Dynamically fetch the first vehicle ID if VEHICLE_ID is not set
+    if not VEHICLE_ID:
+        if not vehicle_manager.vehicles:
+            raise ValueError("No vehicles found in the account. Please ensure your Kia account has at least one vehicle.")
+        # Fetch the first vehicle ID
+        VEHICLE_ID = next(iter(vehicle_manager.vehicles.keys()))
+        logger.info("No VEHICLE_ID provided. Using the first vehicle found: %s", VEHICLE_ID)
+
+    return vehicle_manager
+
+def _exit_for_rejected_credentials():
+    logger.critical("Kia rejected the credentials; shutting down. Fix them and restart.")
+    # os._exit skips atexit, so write out the queued log records first
+    if _log_listener is not None:
+        _log_listener.stop()
+    # Exit status 3 is gunicorn's WORKER_BOOT_ERROR: the arbiter halts instead
+    # of respawning the worker to repeat the same login
+    os._exit(3)
+
+# The Vehicle Manager is created after import rather than during it, so each
+# gunicorn worker logs in on its own after forking and workers boot in parallel.
+# Only the warm-up thread creates it; _vm_ready is set once it has.
+_vm = None
+_vm_ready = threading.Event()
+
+# How long a request waits for the login before giving up with a 503. On
+# Vercel nearly every call is a cold start, so it has to wait for the login.
+_CONNECT_TIMEOUT = 20.0
+
+def get_vm():
+    vm = _vm
+    if vm is None:
+        raise RuntimeError("Not connected to Kia yet")
+    return vm
+
+# Kia's API is occasionally flaky, so keep retrying the login with capped
+# exponential backoff. Rejected credentials shut the server down instead:
+# repeating a bad login only risks locking the Kia account.
+_INIT_RETRY_MAX_DELAY = 300
+
+def _warm_up():
+    global _vm
+    attempt = 0
+    while True:
+        try:
+            vm = _create_vehicle_manager()
+        except AuthenticationError:
+            _exit_for_rejected_credentials()
+        except Exception:
+            delay = min(2 ** attempt, _INIT_RETRY_MAX_DELAY)
+            attempt += 1
+            logger.warning("Initialization attempt %d failed, retrying in %ds", attempt, delay)
+            time.sleep(delay)
+            continue
+        _vm = vm
+        _vm_ready.set()
+        threading.Thread(target=_token_refresher, name="kia-token-refresh", daemon=True).start()
+        return
+
+# Vehicle state refresh is expensive (a round-trip to Kia's servers), so reuse
+# the last refresh for a short window instead of refreshing on every request.
+_REFRESH_TTL = 30.0
+# Monotonic time of the last refresh; None until the first refresh and after
+# an invalidation
+_last_refresh_ts = None
+_refresh_lock = threading.Lock()
+
+# Serialized /list_vehicles body and its ETag, rebuilt whenever the vehicle
+# states refresh. None means not built yet; _NO_VEHICLE_LIST means the account
+# has no vehicles.
+_vehicle_list_cache = None
+_NO_VEHICLE_LIST = (None, None)
+
+def _build_vehicle_list():
+    vehicles = get_vm().vehicles
+    if not vehicles:
+        return _NO_VEHICLE_LIST
+    payload = orjson.dumps({
+        "status": "Success",
+        "vehicles": [
+            {
+                "name": v.name,
+                "id": v.id,
+                "model": v.model,
+                "year": v.year
+            }
+            for v in vehicles.values()
+        ]
+    })
+    return payload, hashlib.blake2b(payload, digest_size=16).hexdigest()
+
+def ensure_fresh(force=False):
+    global _last_refresh_ts, _vehicle_list_cache
+    with _refresh_lock:
+        if (force or _last_refresh_ts is None
+                or time.monotonic() - _last_refresh_ts > _REFRESH_TTL):
+            logger.debug("Refreshing vehicle states...")
+            vm = get_vm()
+            with _token_lock:
+                # Normally a no-op, the background refresher keeps the token valid
+                vm.check_and_refresh_token()
+                vm.update_all_vehicles_with_cached_state()
+                _vehicle_list_cache = _build_vehicle_list()
+            _last_refresh_ts = time.monotonic()
+
+def invalidate_state():
+    # Commands change the vehicle's state, so the next read should refresh
+    global _last_refresh_ts
+    with _refresh_lock:
+        _last_refresh_ts = None
+
+# How often the background thread checks whether the Kia token has expired.
+# The check itself is local; it only logs in again once the token is stale.
+_TOKEN_CHECK_INTERVAL = 60.0
+
+# A re-login replaces the Vehicle Manager's token and rebuilds its vehicles, so
+# it must not run in the middle of a vehicle state refresh: ensure_fresh() holds
+# this lock around the refresh as well. Always taken after _refresh_lock.
+_token_lock = threading.Lock()
+
+def refresh_token():
+    with _token_lock:
+        get_vm().check_and_refresh_token()
+
+# Keep the token current so a request never has to wait on a fresh login
+def _token_refresher():
+    while True:
+        time.sleep(_TOKEN_CHECK_INTERVAL)
+        try:
+            refresh_token()
+        except AuthenticationError:
+            _exit_for_rejected_credentials()
+        except Exception:
+            logger.exception("Background token refresh failed")
+
+# Schema for /start_climate bodies, one property per ClimateRequestOptions
+# field. Compiled once at import; the validator also fills in the defaults.
+_validate_climate = fastjsonschema.compile({
+    "type": "object",
+    "properties": {
+        "climate": {"type": "boolean"},
+        "set_temp": {"type": "number", "default": 22},  # Set temperature in Celsius
+        "duration": {"type": "integer", "default": 10},  # Duration in minutes
+        "defrost": {"type": "boolean"},
+        "front_left_seat": {"type": "integer"},
+        "front_right_seat": {"type": "integer"},
+        "rear_left_seat": {"type": "integer"},
+        "rear_right_seat": {"type": "integer"},
+        "heating": {"type": "integer"},
+        "steering_wheel": {"type": "integer"}
+    },
+    "additionalProperties": False
+})
+
+def build_climate_options(data):
+    # Raises fastjsonschema.JsonSchemaException for invalid settings
+    return ClimateRequestOptions(**_validate_climate(data))
+
+def ojson(data, status=200):
+    return Response(orjson.dumps(data), status=status, mimetype='application/json')
+
+# Fixed responses, serialized once at import. Kept as (body, status, headers)
+# tuples so Flask builds a fresh Response per request around the shared bytes.
+_JSON_HEADERS = {"Content-Type": "application/json"}
+_UNAUTHORIZED = (orjson.dumps({"error": "Unauthorized"}), 403, _JSON_HEADERS)
+_WELCOME = (orjson.dumps({"status": "Welcome to the Kia Vehicle Control API"}), 200, _JSON_HEADERS)
+_HEALTHY = (orjson.dumps({"status": "OK"}), 200, _JSON_HEADERS)
+_NOT_CONNECTED = (orjson.dumps({"error": "Not connected to Kia yet, try again shortly"}), 503, _JSON_HEADERS)
+_INITIALIZING = (orjson.dumps({"status": "Initializing"}), 503, _JSON_HEADERS)
+_NO_VEHICLES = (orjson.dumps({"error": "No vehicles found"}), 404, _JSON_HEADERS)
+_MALFORMED_JSON = (orjson.dumps({"error": "Malformed JSON body"}), 400, _JSON_HEADERS)
+_BAD_BATCH = (orjson.dumps({"error": "Expected a non-empty \"actions\" list"}), 400, _JSON_HEADERS)
+
+def read_json_body():
+    # Parse the body straight from the stream without Flask caching a copy. An
+    # empty body reads as None; malformed JSON raises orjson.JSONDecodeError.
+    body = request.get_data(cache=False)
+    if not body:
+        return None
+    return orjson.loads(body)
 
 # Log incoming requests
 @app.before_request
 def log_request_info():
-    print(f"Incoming request: {request.method} {request.url}")
+    logger.debug("Incoming request: %s %s", request.method, request.url)
+
+# Endpoints reachable without the Authorization header
+_PUBLIC_ENDPOINTS = frozenset({"root", "healthz"})
+
+# Check the Authorization header once for every protected endpoint
+@app.before_request
+def require_authorization():
+    # Unknown URLs have no endpoint and fall through to Flask's 404
+    if request.endpoint is None or request.endpoint in _PUBLIC_ENDPOINTS:
+        return None
+    auth = request.headers.get("Authorization", "").encode()
+    if not hmac.compare_digest(auth, SECRET_KEY_BYTES):
+        logger.warning("Unauthorized request: Missing or incorrect Authorization header")
+        return _UNAUTHORIZED
+
+# Protected endpoints wait, up to _CONNECT_TIMEOUT, for the warm-up thread to
+# log in; only /healthz reports a missing login straight away
+@app.before_request
+def require_connection():
+    if request.endpoint is None or request.endpoint in _PUBLIC_ENDPOINTS:
+        return None
+    if not _vm_ready.wait(_CONNECT_TIMEOUT):
+        return _NOT_CONNECTED
 
 # Root endpoint
 @app.route('/', methods=['GET'])
 def root():
-    return jsonify({"status": "Welcome to the Kia Vehicle Control API"}), 200
+    return _WELCOME
+
+# Health check endpoint: 503 until the Vehicle Manager has logged in
+@app.route('/healthz', methods=['GET'])
+def healthz():
+    if _vm is None:
+        return _INITIALIZING
+    return _HEALTHY
 
 # List vehicles endpoint
 @app.route('/list_vehicles', methods=['GET'])
 def list_vehicles():
-    print("Received request to /list_vehicles")
-
-    if request.headers.get("Authorization") != SECRET_KEY:
-        print("Unauthorized request: Missing or incorrect Authorization header")
-        return jsonify({"error": "Unauthorized"}), 403
-
     try:
-        print("Refreshing vehicle states...")
-        vehicle_manager.update_all_vehicles_with_cached_state()
-
-        vehicles = vehicle_manager.vehicles
-        print(f"Vehicles data: {vehicles}")  # Log the vehicles data
-
-        if not vehicles:
-            print("No vehicles found in the account")
-            return jsonify({"error": "No vehicles found"}), 404
-
-        # Iterate over the dictionary values (Vehicle objects)
-        vehicle_list = [
-            {
-                "name": v.name,
-                "id": v.id,
-                "model": v.model,
-                "year": v.year
-            }
-            for v in vehicles.values()  # Use .values() to get the Vehicle objects
-        ]
-
-        if not vehicle_list:
-            print("No valid vehicles found in the account")
-            return jsonify({"error": "No valid vehicles found"}), 404
-
-        print(f"Returning vehicle list: {vehicle_list}")
-        return jsonify({"status": "Success", "vehicles": vehicle_list}), 200
+        ensure_fresh()
+
+        payload, etag = _vehicle_list_cache
+        if payload is None:
+            logger.info("No vehicles found in the account")
+            return _NO_VEHICLES
+
+        # Let clients that already have this list skip the download
+        if request.if_none_match.contains_weak(etag):
+            response = Response(status=304)
+        else:
+            response = Response(payload, status=200, mimetype='application/json')
+        response.set_etag(etag)
+        response.headers["Cache-Control"] = f"private, max-age={int(_REFRESH_TTL)}"
+        return response
     except Exception as e:
-        print(f"Error in /list_vehicles: {e}")
-        return jsonify({"error": str(e)}), 500
+        logger.error("Error in /list_vehicles: %s", e)
+        return ojson({"error": str(e)}, 500)
 
 # Start climate endpoint
 @app.route('/start_climate', methods=['POST'])
 def start_climate():
-    print("Received request to /start_climate")
-
-    if request.headers.get("Authorization") != SECRET_KEY:
-        print("Unauthorized request: Missing or incorrect Authorization header")
-        return jsonify({"error": "Unauthorized"}), 403
-
     try:
-        print("Refreshing vehicle states...")
-        vehicle_manager.update_all_vehicles_with_cached_state()
-
-        # Create ClimateRequestOptions object with default settings (can be customized)
-        climate_options = ClimateRequestOptions(
-            set_temp=22,  # Set temperature in Celsius
-            duration=10   # Duration in minutes
-        )
+        # Default settings, overridden by any fields in the JSON body; only an
+        # empty body means "use the defaults"
+        data = read_json_body()
+        climate_options = build_climate_options({} if data is None else data)
+    except orjson.JSONDecodeError:
+        return _MALFORMED_JSON
+    except fastjsonschema.JsonSchemaException as e:
+        return ojson({"error": f"Invalid climate options: {e.message}"}, 400)
 
+    try:
+        refresh_token()
         # Start climate control using the VehicleManager's start_climate method
-        result = vehicle_manager.start_climate(VEHICLE_ID, climate_options)
-        print(f"Start climate result: {result}")
+        result = get_vm().start_climate(VEHICLE_ID, climate_options)
+        invalidate_state()
+        logger.info("Start climate result: %s", result)
 
-        return jsonify({"status": "Climate started", "result": result}), 200
+        return ojson({"status": "Climate started", "result": result})
     except Exception as e:
-        print(f"Error in /start_climate: {e}")
-        return jsonify({"error": str(e)}), 500
-
-# Stop climate endpoint
-@app.route('/stop_climate', methods=['POST'])
-def stop_climate():
-    print("Received request to /stop_climate")
-
-    if request.headers.get("Authorization") != SECRET_KEY:
-        print("Unauthorized request: Missing or incorrect Authorization header")
-        return jsonify({"error": "Unauthorized"}), 403
+        logger.error("Error in /start_climate: %s", e)
+        return ojson({"error": str(e)}, 500)
+
+# Commands that need nothing but the vehicle ID: the status to report and the
+# Vehicle Manager call to make. The calls take the same (vm, options) arguments
+# as the /batch operations and ignore the options.
+_DISPATCH = {
+    "lock": ("Car locked", lambda vm, options: vm.lock(VEHICLE_ID)),
+    "unlock": ("Car unlocked", lambda vm, options: vm.unlock(VEHICLE_ID)),
+    "stop_climate": ("Climate stopped", lambda vm, options: vm.stop_climate(VEHICLE_ID)),
+}
+
+# Command endpoint: POST /command/lock, /command/unlock or /command/stop_climate
+@app.route('/command/<action>', methods=['POST'])
+def command(action):
+    entry = _DISPATCH.get(action)
+    if entry is None:
+        return ojson({"error": f"Unknown command: {action}"}, 404)
+    status, run = entry
 
     try:
-        print("Refreshing vehicle states...")
-        vehicle_manager.update_all_vehicles_with_cached_state()
-
-        # Stop climate control using the VehicleManager's stop_climate method
-        result = vehicle_manager.stop_climate(VEHICLE_ID)
-        print(f"Stop climate result: {result}")
+        refresh_token()
+        result = run(get_vm(), {})
+        invalidate_state()
+        logger.info("%s result: %s", action, result)
 
-        return jsonify({"status": "Climate stopped", "result": result}), 200
+        return ojson({"status": status, "result": result})
     except Exception as e:
-        print(f"Error in /stop_climate: {e}")
-        return jsonify({"error": str(e)}), 500
+        logger.error("Error in /command/%s: %s", action, e)
+        return ojson({"error": str(e)}, 500)
+
+# The original per-command endpoints stay for existing shortcuts
+@app.route('/stop_climate', methods=['POST'])
+def stop_climate():
+    return command("stop_climate")
 
-# Unlock car endpoint
 @app.route('/unlock_car', methods=['POST'])
 def unlock_car():
-    print("Received request to /unlock_car")
-
-    if request.headers.get("Authorization") != SECRET_KEY:
-        print("Unauthorized request: Missing or incorrect Authorization header")
-        return jsonify({"error": "Unauthorized"}), 403
-
-    try:
-        print("Refreshing vehicle states...")
-        vehicle_manager.update_all_vehicles_with_cached_state()
-
-        # Unlock the vehicle using the VehicleManager's unlock method
-        result = vehicle_manager.unlock(VEHICLE_ID)
-        print(f"Unlock result: {result}")
+    return command("unlock")
 
-        return jsonify({"status": "Car unlocked", "result": result}), 200
-    except Exception as e:
-        print(f"Error in /unlock_car: {e}")
-        return jsonify({"error": str(e)}), 500
-
-# Lock car endpoint
 @app.route('/lock_car', methods=['POST'])
 def lock_car():
-    print("Received request to /lock_car")
-
-    if request.headers.get("Authorization") != SECRET_KEY:
-        print("Unauthorized request: Missing or incorrect Authorization header")
-        return jsonify({"error": "Unauthorized"}), 403
-
+    return command("lock")
+
+# Operations accepted by /batch; each takes the Vehicle Manager and the
+# action's "options" object
+_BATCH_OPS = {
+    **{action: run for action, (_, run) in _DISPATCH.items()},
+    "start_climate": lambda vm, options: vm.start_climate(
+        VEHICLE_ID, build_climate_options(options)
+    ),
+}
+
+# Batch endpoint: run several commands in one request, e.g.
+# {"actions": [{"op": "unlock"}, {"op": "start_climate", "options": {"set_temp": 20}}]}
+@app.route('/batch', methods=['POST'])
+def batch():
     try:
-        print("Refreshing vehicle states...")
-        vehicle_manager.update_all_vehicles_with_cached_state()
-
-        # Lock the vehicle using the VehicleManager's lock method
-        result = vehicle_manager.lock(VEHICLE_ID)
-        print(f"Lock result: {result}")
+        data = read_json_body()
+    except orjson.JSONDecodeError:
+        return _MALFORMED_JSON
+    actions = data.get("actions") if isinstance(data, dict) else None
+    if not isinstance(actions, list) or not actions:
+        return _BAD_BATCH
 
-        return jsonify({"status": "Car locked", "result": result}), 200
+    try:
+        vm = get_vm()
+        refresh_token()
     except Exception as e:
-        print(f"Error in /lock_car: {e}")
-        return jsonify({"error": str(e)}), 500
+        logger.error("Error in /batch: %s", e)
+        return ojson({"error": str(e)}, 500)
+
+    results = []
+    for action in actions:
+        op = action.get("op") if isinstance(action, dict) else None
+        # Only strings can name an operation (and be used as a dict key)
+        handler = _BATCH_OPS.get(op) if isinstance(op, str) else None
+        if handler is None:
+            results.append({"op": op, "error": "Unknown operation"})
+            continue
+        options = action.get("options") or {}
+        try:
+            result = handler(vm, options)
+            logger.info("Batch %s result: %s", op, result)
+            results.append({"op": op, "result": result})
+        except Exception as e:
+            logger.error("Error in /batch %s: %s", op, e)
+            results.append({"op": op, "error": str(e)})
+
+    invalidate_state()
+
+    return ojson({"status": "Batch completed", "results": results})
+
+# Log in from a background thread as soon as the worker starts, so /healthz
+# can report when it is ready. Started last so everything it touches is defined.
+threading.Thread(target=_warm_up, name="kia-warm-up", daemon=True).start()
 
 if __name__ == "__main__":
-    print("Starting Kia Vehicle Control API...")
+    logger.info("Starting Kia Vehicle Control API...")
     app.run(host="0.0.0.0", port=8080)